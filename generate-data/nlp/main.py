@@ -1,12 +1,30 @@
-import json
+import hashlib
+import itertools
+import logging
+import os
+import pickle
 import sys
-from typing import List, Dict, Optional, Set, Tuple
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import ahocorasick
+import numpy
+import orjson
 import spacy
-from spacy.matcher import DependencyMatcher, PhraseMatcher
+from spacy.attrs import DEP, HEAD, IDX, LEMMA, LENGTH, MORPH, ORTH, POS, SPACY
+from spacy.matcher import DependencyMatcher
+from spacy.morphology import Morphology
 from pathlib import Path
 from tqdm import tqdm
 from typing import NamedTuple
 
+try:
+    import torch
+except ImportError:  # Only installed alongside the transformer pipelines
+    torch = None
+
+logger = logging.getLogger(__name__)
+
 class Term(NamedTuple):
     term: str
     start_char: int
@@ -62,83 +80,236 @@ MODEL_MAPPING = {
 
 use_big_model = True
 
+# Built patterns are cached here, keyed by the terms file, language, model and this module's source
+# (superseded files for the same terms file and model are removed whenever a new one is written)
+PATTERNS_CACHE_DIR = Path(__file__).parent / ".cache"
+# Any edit to this module (pattern logic, NEG_PARTS, the cached data's shape, ...) changes this
+# digest and so invalidates every cached file; delete the directory to force a rebuild otherwise
+PATTERNS_CACHE_SOURCE_DIGEST = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
 class MultiwordTermDetector:
-    def __init__(self, terms_file: str, language_code: str):
+    def __init__(self, terms_file: str, language_code: str, with_entities: bool = False):
         # Load spaCy model for the specified language
         models = MODEL_MAPPING.get(language_code)
         if not models:
             raise ValueError(f"Unsupported language code: {language_code}")
         
         model_name = models["large"] if use_big_model else models["small"]
-        self.nlp = spacy.load(model_name)
+        # Transformer pipelines run much faster on a GPU; this has to happen before loading.
+        # On the GPU the transformer also runs in half precision.
+        use_gpu = model_name.endswith("_trf") and spacy.prefer_gpu()
+        if use_gpu:
+            logger.info("Using GPU")
+            self.nlp = spacy.load(model_name, config={"components": {"transformer": {"model": {"mixed_precision": True}}}})
+        else:
+            self.nlp = spacy.load(model_name)
         self.language_code = language_code
-        print(f"Pipeline components: {self.nlp.pipe_names}")
+
+        # NER is one of the heaviest components and only feeds the optional "entities" output
+        self.with_entities = with_entities
+        if not with_entities and "ner" in self.nlp.pipe_names:
+            self.nlp.disable_pipe("ner")
+        logger.info(f"Pipeline components: {self.nlp.pipe_names}")
+
+        # Transformer pipelines are already multi-threaded (or on the GPU) and too heavy to fork,
+        # so they run in one process with bigger batches; the others fan out over all cores.
+        self._is_trf = any("transformer" in name for name in self.nlp.pipe_names)
+        self._n_process = 1 if self._is_trf else os.cpu_count()
+        self._batch_size = 256 if self._is_trf else 64
+        if self._is_trf:
+            # Don't randomly empty the CUDA cache between batches
+            transformer = self.nlp.get_pipe("transformer")
+            if "flush_cache_chance" in transformer.model.attrs:
+                transformer.model.attrs["flush_cache_chance"] = 0
         
-        # Initialize both matchers
+        # Initialize the dependency matcher; the lemma sequence matcher is built from the mappings
         self.dep_matcher = DependencyMatcher(self.nlp.vocab)
-        self.phrase_matcher = PhraseMatcher(self.nlp.vocab, attr="LEMMA")
         
         # Load multiword terms
-        print(f"Loading multiword terms from {terms_file}...")
+        logger.info(f"Loading multiword terms from {terms_file}...")
         self.multiword_terms = self._load_terms(terms_file)
-        print(f"Loaded {len(self.multiword_terms)} multiword terms")
+        logger.info(f"Loaded {len(self.multiword_terms)} multiword terms")
         
-        # Pre-compute lemmatized form mappings and create patterns
-        print("Creating patterns and lemma mappings...")
-        self.lemma_to_terms = {}  # Maps tuple of lemmas to list of original terms
-        self._create_patterns_and_mappings()
-        print(f"Created patterns for {len(self.dep_matcher)} dependency patterns and phrase patterns")
+        # Terms are stored as (term, term hash) pairs, so matching never has to hash them again
+        self.lemma_to_terms: Dict[Tuple[int, ...], Set[Tuple[str, int]]] = {}  # Maps lemma hash tuples to terms
+        self.single_token_terms: Dict[str, Set[Tuple[str, int]]] = {}  # Maps lowercase text to single-token terms
+
+        # Reuse the patterns from a previous run on the same terms file if there is one
+        cache_path = self._patterns_cache_path(terms_file)
+        if cache_path.exists():
+            logger.info(f"Loading patterns and lemma mappings from {cache_path}...")
+            dep_patterns = self._load_patterns(cache_path)
+        else:
+            # Pre-compute lemmatized form mappings and create patterns
+            logger.info("Creating patterns and lemma mappings...")
+            dep_patterns = self._create_patterns_and_mappings()
+            self._save_patterns(cache_path, dep_patterns)
+
+        for term, patterns in dep_patterns.items():
+            self.dep_matcher.add(term, patterns)
+        self._build_lemma_automaton()
+        logger.info(f"Created patterns for {len(self.dep_matcher)} dependency patterns, "
+                    f"{len(self.single_token_terms)} single-token lookups and "
+                    f"{len(self.lemma_to_terms)} lemma sequences")
     
+    def _patterns_cache_path(self, terms_file: str) -> Path:
+        """
+        Cache file for the patterns built from `terms_file` with the current model.
+
+        The name starts with a digest of the terms file's path, the language and the model size,
+        shared by every cache built for them, followed by a digest of everything else the
+        patterns depend on.
+        """
+        stat = os.stat(terms_file)
+        setup = repr((str(Path(terms_file).resolve()), self.language_code, use_big_model))
+        state = repr((
+            PATTERNS_CACHE_SOURCE_DIGEST,
+            stat.st_mtime_ns,
+            stat.st_size,
+            self.nlp.meta.get("version"),
+        ))
+        setup_digest = hashlib.sha256(setup.encode("utf-8")).hexdigest()[:16]
+        state_digest = hashlib.sha256(state.encode("utf-8")).hexdigest()[:16]
+        return PATTERNS_CACHE_DIR / f"mwt_{setup_digest}_{state_digest}.pkl"
+
+    def _save_patterns(self, cache_path: Path, dep_patterns: Dict[str, List]):
+        """Write the lemma mappings and dependency patterns to `cache_path`"""
+        data = {
+            "lemma_to_terms": self.lemma_to_terms,
+            "single_token_terms": self.single_token_terms,
+            "dep_patterns": dep_patterns,
+        }
+
+        # Write to a temporary file first so an interrupted run can't leave a truncated cache
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+        # Older caches for the same terms file and model can never be loaded again
+        setup_prefix = cache_path.name.rsplit("_", 1)[0]
+        for stale_path in cache_path.parent.glob(f"{setup_prefix}_*.pkl"):
+            if stale_path != cache_path:
+                stale_path.unlink(missing_ok=True)
+
+    def _load_patterns(self, cache_path: Path) -> Dict[str, List]:
+        """Read the lemma mappings and dependency patterns written by `_save_patterns`"""
+        with open(cache_path, 'rb') as f:
+            data = pickle.load(f)
+
+        self.lemma_to_terms = data["lemma_to_terms"]
+        self.single_token_terms = data["single_token_terms"]
+        return data["dep_patterns"]
+
+    def _build_lemma_automaton(self):
+        """
+        Build an Aho-Corasick automaton over the lemma sequences in `lemma_to_terms`, used for
+        the high confidence matches.
+
+        Every distinct pattern lemma is given its own character, so a doc becomes a string with
+        exactly one character per token and match offsets are token indices.
+        """
+        self.lemma_chars: Dict[int, str] = {}  # Maps lemma hashes to their character
+        self.lemma_automaton = ahocorasick.Automaton()
+
+        for lemma_tuple, terms in self.lemma_to_terms.items():
+            for lemma in lemma_tuple:
+                if lemma not in self.lemma_chars:
+                    # Start at 1 ("\0" stands for lemmas no pattern uses) and skip the surrogates
+                    code = len(self.lemma_chars) + 1
+                    if code >= 0xD800:
+                        code += 0x800
+                    if code > sys.maxunicode:
+                        raise ValueError(
+                            f"Too many distinct lemmas in the multiword terms: the automaton gives each "
+                            f"one a character and runs out after {len(self.lemma_chars)}")
+                    self.lemma_chars[lemma] = chr(code)
+            key = "".join(self.lemma_chars[lemma] for lemma in lemma_tuple)
+            self.lemma_automaton.add_word(key, (len(lemma_tuple), terms))
+
+        if self.lemma_to_terms:
+            self.lemma_automaton.make_automaton()
+
     def _load_terms(self, terms_file: str) -> List[str]:
         """Load multiword terms from file"""
         with open(terms_file, 'r', encoding='utf-8') as f:
             return [line.strip() for line in f if line.strip()]
     
-    def _create_patterns_and_mappings(self):
-        """Create both dependency and phrase patterns for each multiword term, and lemma mappings"""
+    def _create_patterns_and_mappings(self) -> Dict[str, List]:
+        """
+        Create dependency patterns and lemma mappings for each multiword term.
+        Returns the dependency patterns by term.
+        """
         batch_size = 1000
-        phrase_patterns = []
-        
-        for i in tqdm(range(0, len(self.multiword_terms), batch_size), desc="Creating patterns and mappings"):
-            batch = self.multiword_terms[i:i+batch_size]
-            
-            # Process batch with nlp.pipe for efficiency (only once!)
-            docs = list(self.nlp.pipe(batch, batch_size=100))
-            
-            for term, doc in zip(batch, docs):
-                # Create lemma mapping
-                lemma_tuple = tuple(token.lemma_ for token in doc)
-                if lemma_tuple not in self.lemma_to_terms:
-                    self.lemma_to_terms[lemma_tuple] = []
-                self.lemma_to_terms[lemma_tuple].append(term)
-                
-                # Add to PhraseMatcher for high confidence sequential matching
-                phrase_patterns.append(doc)
-                
-                # Skip single-token terms for DependencyMatcher
-                if len(doc) == 1:
-                    # For single tokens, we'll need a different approach
-                    # For now, let's create a simple pattern
-                    pattern = [{"RIGHT_ID": "single", "RIGHT_ATTRS": {"LOWER": doc[0].text.lower()}}]
-                    self.dep_matcher.add(term, [pattern])
-                    continue
-                
-                patterns = []
-                pat = self._create_dependency_pattern_for_doc(doc)
-                if pat:
-                    patterns.append(pat)
-                
-                if patterns:
-                    self.dep_matcher.add(term, patterns)
-        
-        # Add all phrase patterns at once for efficiency
-        self.phrase_matcher.add("MULTIWORD_TERMS", phrase_patterns)
+        dep_patterns: Dict[str, List] = {}
+
+        # Repeated terms are analysed once. Spellings that only differ in case are kept apart:
+        # they can lemmatize and parse differently ("Paris" / "paris").
+        unique_terms = list(dict.fromkeys(self.multiword_terms))
+
+        # Split terms by token count with the tokenizer alone (cheap)
+        singles, multis = [], []
+        for term, doc in zip(unique_terms, self.nlp.tokenizer.pipe(unique_terms, batch_size=batch_size)):
+            (singles if len(doc) == 1 else multis).append(term)
+
+        # None of the patterns look at entities or categories
+        unused = self._unused_pipes("ner", "textcat")
+
+        # For transformers, batches that fit comfortably on the GPU
+        nlp_batch_size = 256 if self._is_trf else batch_size
+
+        # Single-token terms only need lemmas, so they skip the parser
+        with self.nlp.select_pipes(disable=unused + self._unused_pipes("parser")), self._inference_mode():
+            docs = self.nlp.pipe(singles, batch_size=nlp_batch_size)
+            for term, doc in tqdm(zip(singles, docs), total=len(singles), desc="Creating single-token patterns"):
+                self._add_term_patterns(term, doc, dep_patterns)
+
+        with self.nlp.select_pipes(disable=unused), self._inference_mode():
+            docs = self.nlp.pipe(multis, batch_size=nlp_batch_size, n_process=self._n_process)
+            for term, doc in tqdm(zip(multis, docs), total=len(multis), desc="Creating multi-token patterns"):
+                self._add_term_patterns(term, doc, dep_patterns)
+
+        return dep_patterns
+
+    def _inference_mode(self):
+        """Context manager that skips autograd bookkeeping during transformer forward passes"""
+        return torch.inference_mode() if torch is not None and self._is_trf else nullcontext()
+
+    def _unused_pipes(self, *names: str) -> List[str]:
+        """Return the components in `names` that are currently enabled in the pipeline"""
+        return [name for name in names if name in self.nlp.pipe_names]
+
+    def _add_term_patterns(self, term: str, doc, dep_patterns: Dict[str, List]):
+        """Register the lemma mapping and matcher patterns for a single processed term"""
+        # Create lemma mapping from the lemma hashes (no per-token string lookups). Each lemma
+        # tuple becomes one high confidence pattern reporting every term sharing it.
+        lemma_tuple = tuple(doc.to_array(LEMMA).tolist())
+        term_entry = (term, self.nlp.vocab.strings[term])
+        if lemma_tuple not in self.lemma_to_terms:
+            self.lemma_to_terms[lemma_tuple] = set()
+        self.lemma_to_terms[lemma_tuple].add(term_entry)
+
+        # Skip single-token terms for DependencyMatcher: a lowercase lookup finds them
+        # without adding a pattern per term to its match loop
+        if len(doc) == 1:
+            self.single_token_terms.setdefault(doc[0].text.lower(), set()).add(term_entry)
+            return
+
+        patterns = []
+        pat = self._create_dependency_pattern_for_doc(doc)
+        if pat:
+            patterns.append(pat)
+
+        if patterns:
+            dep_patterns[term] = patterns
 
     def _create_dependency_pattern_for_doc(self, doc) -> Optional[List[Dict]]:
-        print("creating pattern for", doc, ":", [
-            {"lemma": t.lemma_, "text": t.text, "dep": t.dep_, "head": t.head.i}
-            for t in doc
-        ])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("creating pattern for %s: %s", doc, [
+                {"lemma": t.lemma_, "text": t.text, "dep": t.dep_, "head": t.head.i}
+                for t in doc
+            ])
 
         # Language-specific pattern handling
         if self.language_code == "fra":
@@ -161,7 +332,7 @@ class MultiwordTermDetector:
                         "RIGHT_ATTRS": {"LEMMA": second},
                     },
                 ]
-                print("negation pattern for", doc, ":", pat)
+                logger.debug("negation pattern for %s: %s", doc, pat)
                 return pat
         elif self.language_code == "spa":
             # Spanish-specific patterns can be added here if needed
@@ -196,7 +367,7 @@ class MultiwordTermDetector:
 
         root = doc[:].sent.root
         pat = self._create_pattern_for_token(root, keep=("LEMMA",))
-        print("pattern for", doc, ":", pat)
+        logger.debug("pattern for %s: %s", doc, pat)
         return pat
 
 
@@ -236,12 +407,15 @@ class MultiwordTermDetector:
         def make_id(tok):          # stable but short IDs
             return f"t{tok.i}"
 
+        # attribute names to copy, e.g. ("LEMMA", "lemma_")
+        attr_keys = [(k, k.lower() + "_") for k in keep if k != "DEP"]
+        keep_dep = "DEP" in keep
+
         # anchor node
         id_map[root.i] = make_id(root)
         pattern.append({
             "RIGHT_ID": id_map[root.i],
-            "RIGHT_ATTRS": {k: getattr(root, k.lower() + "_")
-                            for k in keep if k != "DEP"}
+            "RIGHT_ATTRS": {k: getattr(root, attr) for k, attr in attr_keys}
         })
 
         # ------------------------------------------------------------------
@@ -249,13 +423,14 @@ class MultiwordTermDetector:
         #    when they fall outside root.subtree (they often do).
         # ------------------------------------------------------------------
         always_take = {"cop", "aux", "case"}
-        queue = [root]
+        subtree_ids = {t.i for t in root.subtree}
+        queue = deque([root])
 
         while queue:
-            parent = queue.pop(0)
+            parent = queue.popleft()
             for child in parent.children:
 
-                if child.dep_ not in always_take and child not in root.subtree:
+                if child.dep_ not in always_take and child.i not in subtree_ids:
                     continue
 
                 id_map[child.i] = make_id(child)
@@ -263,9 +438,8 @@ class MultiwordTermDetector:
                 # choose operator: '>' for direct child, '>>' for deeper
                 rel_op = ">" if child.head is parent else ">>"
 
-                attrs = {k: getattr(child, k.lower() + "_")
-                        for k in keep if k != "DEP"}
-                if "DEP" in keep:
+                attrs = {k: getattr(child, attr) for k, attr in attr_keys}
+                if keep_dep:
                     attrs["DEP"] = child.dep_
 
                 pattern.append({
@@ -284,60 +458,86 @@ class MultiwordTermDetector:
         Find multiword terms in a batch of sentences using both matchers.
         Returns list of results with high and low confidence matches.
         """
-        # Process sentences in batch
-        docs = list(self.nlp.pipe(sentences, batch_size=100))
+        # Process sentences in batch. This stays in one process: starting workers costs more than
+        # a batch is worth, see `find_multiword_terms_stream` for whole inputs.
+        with self._inference_mode():
+            docs = list(self.nlp.pipe(sentences, batch_size=self._batch_size))
         
-        results = []
-        for doc in docs:
-            #print("doc:", doc, "full doc:", [{"lemma": token.lemma_, "text": token.text, "dep": token.dep_, "head": token.head.i} for token in doc])
-            
-            # High confidence: PhraseMatcher (sequential lemma matching)
-            phrase_matches = self.phrase_matcher(doc)
-            high_confidence_terms = set()
-            
-            for match_id, start, end in phrase_matches:
-                # Get the matched span
-                span = doc[start:end]
-                
-                # Create lemma tuple for the span
-                span_lemma_tuple = tuple(token.lemma_ for token in span)
+        return [(doc, self._detect_terms(doc)) for doc in docs]
+
+    def find_multiword_terms_stream(self, items: Iterable[Tuple[str, Any]]) -> Iterator[Tuple[Any, Any, DetectedTerms]]:
+        """
+        Find multiword terms in a stream of (sentence, context) pairs, yielding
+        (doc, context, detected terms) in input order.
+
+        Everything goes through a single `nlp.pipe` call, so for non-transformer pipelines the
+        worker processes are only started once for the whole input.
+        """
+        with self._inference_mode():
+            docs = self.nlp.pipe(items, as_tuples=True, batch_size=self._batch_size, n_process=self._n_process)
+            for doc, context in docs:
+                yield doc, context, self._detect_terms(doc)
+
+    def _detect_terms(self, doc) -> DetectedTerms:
+        """Find the high and low confidence multiword terms in a processed doc"""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("doc: %s, full doc: %s", doc, [{"lemma": token.lemma_, "text": token.text, "dep": token.dep_, "head": token.head.i} for token in doc])
+        
+        # Character offsets of every token, read once for all the matches below
+        offsets = doc.to_array([IDX, LENGTH])
+        starts = offsets[:, 0].tolist()
+        ends = (offsets[:, 0] + offsets[:, 1]).tolist()
+
+        # High confidence: sequential lemma matching, scanning the doc's lemmas (one character
+        # per token) with the Aho-Corasick automaton. Matches are deduplicated through one int
+        # per (term hash, start, end), which hashes faster than a Term tuple; character
+        # offsets get 32 bits each, so they cannot spill into their neighbours on any real line.
+        lemma_chars = self.lemma_chars
+        lemma_text = "".join([lemma_chars.get(lemma, "\0") for lemma in doc.to_array(LEMMA).tolist()])
+        high_confidence_keys: Set[int] = set()
+        high_confidence_terms: List[Term] = []
+        
+        if self.lemma_to_terms:
+            for end, (length, terms) in self.lemma_automaton.iter(lemma_text):
+                # Get character positions; `end` is the index of the last matched token
+                start_char = starts[end - length + 1]
+                end_char = ends[end]
                 
-                # Look up original terms using pre-computed mapping
-                if span_lemma_tuple in self.lemma_to_terms:
-                    # Get character positions
-                    start_char = span[0].idx
-                    end_char = span[-1].idx + len(span[-1].text)
-                    
-                    # Add all matching original terms (handles multiple terms with same lemmatized form)
-                    for original_term in self.lemma_to_terms[span_lemma_tuple]:
-                        high_confidence_terms.add(Term(original_term, start_char, end_char))
+                # Add all original terms of the matched lemma tuple
+                # (handles multiple terms with same lemmatized form)
+                for original_term, term_hash in terms:
+                    key = (term_hash << 64) | (start_char << 32) | end_char
+                    if key not in high_confidence_keys:
+                        high_confidence_keys.add(key)
+                        high_confidence_terms.append(Term(original_term, start_char, end_char))
+        
+        # Low confidence: DependencyMatcher
+        dep_matches = self.dep_matcher(doc)
+        low_confidence_terms = []
+        
+        for match_id, token_ids in dep_matches:
+            # Get the matched term name
+            term = self.nlp.vocab.strings[match_id]
             
-            # Low confidence: DependencyMatcher
-            dep_matches = self.dep_matcher(doc)
-            low_confidence_terms = []
+            # Get character positions from the first and last matched tokens
+            start_char = starts[min(token_ids)]
+            end_char = ends[max(token_ids)]
             
-            for match_id, token_ids in dep_matches:
-                # Get the matched term name
-                term = self.nlp.vocab.strings[match_id]
-                
-                # Get the span of tokens
-                tokens = sorted(token_ids)  # Ensure tokens are in order
-                start_token = doc[tokens[0]]
-                end_token = doc[tokens[-1]]
-                
-                # Get character positions
-                start_char = start_token.idx
-                end_char = end_token.idx + len(end_token.text)
-                
-                term_obj = Term(term, start_char, end_char)
-                
-                # Only add to low confidence if not already in high confidence
-                if term_obj not in high_confidence_terms:
-                    low_confidence_terms.append(term_obj)
-            
-            results.append((doc, DetectedTerms(list(high_confidence_terms), low_confidence_terms)))
-        
-        return results
+            # Only add to low confidence if not already in high confidence
+            # (the match id is the term's hash)
+            key = (match_id << 64) | (start_char << 32) | end_char
+            if key not in high_confidence_keys:
+                low_confidence_terms.append(Term(term, start_char, end_char))
+
+        # Low confidence: single-token terms by lowercase text
+        for token in doc:
+            for term, term_hash in self.single_token_terms.get(token.lower_, ()):
+                start_char, end_char = starts[token.i], ends[token.i]
+                key = (term_hash << 64) | (start_char << 32) | end_char
+                if key not in high_confidence_keys:
+                    low_confidence_terms.append(Term(term, start_char, end_char))
+
+        return DetectedTerms(high_confidence_terms, low_confidence_terms)
     
     def find_multiword_terms(self, sentence: str) -> Tuple[any, DetectedTerms]:
         """
@@ -357,111 +557,125 @@ class MultiwordTermDetector:
                   f"dep: {token.dep_}, head: {token.head.i})")
         return doc
 
-def process_sentences(sentences_file: str, terms_file: str, output_file: str, language_code: str):
+# Token attributes written to the output, in the order `doc_to_token_dicts` unpacks them
+TOKEN_ATTRS = [ORTH, SPACY, LEMMA, POS, MORPH, DEP, HEAD]
+
+def doc_to_token_dicts(doc, strings: Dict[int, str], morphs: Dict[int, Dict[str, str]]) -> List[Dict]:
+    """
+    Convert the tokens of `doc` into the dicts written to the output file.
+
+    All attributes are read with a single `doc.to_array` call and their ids are resolved
+    through the `strings`/`morphs` caches, which can be shared across docs, instead of going
+    through the Token properties one by one.
+    """
+    vocab_strings = doc.vocab.strings
+
+    def string(key: int) -> str:
+        if key not in strings:
+            strings[key] = vocab_strings[key]
+        return strings[key]
+
+    array = doc.to_array(TOKEN_ATTRS)
+    # HEAD is stored as an offset from the token, wrapped around in the unsigned array
+    heads = (array[:, -1].astype(numpy.int64) + numpy.arange(len(doc))).tolist()
+
+    tokens = []
+    for (orth, space, lemma, pos, morph, dep, _), head in zip(array.tolist(), heads):
+        if morph not in morphs:
+            morphs[morph] = Morphology.feats_to_dict(string(morph))
+        tokens.append({"text": string(orth),
+                       "whitespace": " " if space else "",
+                       "lemma": string(lemma),
+                       "pos": string(pos),
+                       "morph": morphs[morph],
+                       "dep": string(dep),
+                       "head": head})
+    return tokens
+
+def process_sentences(sentences_file: str, terms_file: str, output_file: str, language_code: str,
+                      with_entities: bool = False):
     """Process sentences from JSONL file and add multiword terms"""
     print(f"\nInitializing multiword term detector for language: {language_code}...")
-    detector = MultiwordTermDetector(terms_file, language_code)
+    detector = MultiwordTermDetector(terms_file, language_code, with_entities)
     
-    # Count total lines first for progress bar
-    print("\nCounting sentences...")
-    with open(sentences_file, 'r', encoding='utf-8') as f:
-        total_lines = sum(1 for line in f if line.strip())
-    print(f"Found {total_lines} sentences to process")
+    # Estimate the number of lines for the progress bar from the first few, rather than
+    # reading the whole file an extra time
+    file_size = os.path.getsize(sentences_file)
+    with open(sentences_file, 'rb') as f:
+        sample = [len(line) for line in itertools.islice(f, 128)]
+    average_line_length = sum(sample) / max(1, len(sample))
+    total_lines = int(file_size / max(1, average_line_length))
+    print(f"\nFound about {total_lines} sentences to process")
     
     print("\nProcessing sentences...")
-    batch_size = 1000  # Process 1000 entries at a time
+    batch_size = 1000  # Write 1000 entries at a time
+
+    # Vocab ids resolved while writing tokens, shared across all sentences
+    strings: Dict[int, str] = {}
+    morphs: Dict[int, Dict[str, str]] = {}
+
+    def read_sentences(infile):
+        # (text, context) pairs for the detector; the context is the sentence itself, echoed back
+        # next to its doc so it can be written out unchanged
+        for line in infile:
+            if not line.strip():
+                continue
+            sentence = orjson.loads(line)
+            yield sentence, sentence
     
-    with open(sentences_file, 'r', encoding='utf-8') as infile, \
-         open(output_file, 'w', encoding='utf-8') as outfile:
+    with open(sentences_file, 'rb') as infile, \
+         open(output_file, 'wb', buffering=1 << 20) as outfile:
         
-        # Process in batches
-        batch_sentences = []
+        # The whole input goes through one stream, so worker processes start only once
+        results = detector.find_multiword_terms_stream(read_sentences(infile))
+        out_buf: List[bytes] = []
         
-        for line in tqdm(infile, total=total_lines, desc="Processing", unit="sentences"):
-            if not line.strip():
-                continue
+        for doc, sentence, detected_terms in tqdm(results, total=total_lines, desc="Processing", unit="sentences"):
+            # Store term names by confidence level
+            high_confidence_names = list({term.term for term in detected_terms.high_confidence})
+            low_confidence_names = list({term.term for term in detected_terms.low_confidence})
             
-            sentence = json.loads(line)
-            batch_sentences.append(sentence)
-            
-            # Process batch when it's full
-            if len(batch_sentences) >= batch_size:
-                # Find multiword terms for all sentences in batch
-                all_terms = detector.find_multiword_terms_batch(batch_sentences)
-                
-                # Process each sentence and its results
-                for sentence, (doc, detected_terms) in zip(batch_sentences, all_terms):
-                    # Store term names by confidence level
-                    high_confidence_names = list(set([term.term for term in detected_terms.high_confidence]))
-                    low_confidence_names = list(set([term.term for term in detected_terms.low_confidence]))
-                    
-                    # Create a dict with the sentence and its multiword terms
-                    sentence_with_terms = {
-                        "sentence": sentence,
-                        "multiword_terms": {
-                            "high_confidence": high_confidence_names,
-                            "low_confidence": low_confidence_names
-                        },
-                        "doc": [{"text": token.text, 
-                                "whitespace": token.whitespace_,
-                                "lemma": token.lemma_, 
-                                "pos": token.pos_,
-                                "morph": token.morph.to_dict(),
-                                "dep": token.dep_} for token in doc],
-                        "entities": [(ent.text, ent.label_) for ent in doc.ents],
-                    }
-
-                    # Write the enhanced data
-                    outfile.write(json.dumps(sentence_with_terms, ensure_ascii=False) + '\n')
-                
-                # Clear batch
-                batch_sentences = []
+            # Create a dict with the sentence and its multiword terms
+            sentence_with_terms = {
+                "sentence": sentence,
+                "multiword_terms": {
+                    "high_confidence": high_confidence_names,
+                    "low_confidence": low_confidence_names
+                },
+                "doc": doc_to_token_dicts(doc, strings, morphs),
+                "entities": [(ent.text, ent.label_) for ent in doc.ents] if detector.with_entities else [],
+            }
+            out_buf.append(orjson.dumps(sentence_with_terms) + b'\n')
+
+            # Write the enhanced data in chunks rather than line by line
+            if len(out_buf) >= batch_size:
+                outfile.writelines(out_buf)
+                out_buf = []
         
-        # Process remaining sentences
-        if batch_sentences:
-            # Find multiword terms for all sentences in batch
-            all_terms = detector.find_multiword_terms_batch(batch_sentences)
-            
-            # Process each sentence and its results
-            for sentence, (doc, detected_terms) in zip(batch_sentences, all_terms):
-                # Store term names by confidence level
-                high_confidence_names = list(set([term.term for term in detected_terms.high_confidence]))
-                low_confidence_names = list(set([term.term for term in detected_terms.low_confidence]))
-                
-                # Create a dict with the sentence and its multiword terms
-                sentence_with_terms = {
-                    "sentence": sentence,
-                    "multiword_terms": {
-                        "high_confidence": high_confidence_names,
-                        "low_confidence": low_confidence_names
-                    },
-                    "doc": [{"text": token.text, 
-                            "whitespace": token.whitespace_,
-                            "lemma": token.lemma_, 
-                            "pos": token.pos_,
-                            "morph": token.morph.to_dict(),
-                            "dep": token.dep_,
-                            "head": token.head.i} for token in doc],
-                    "entities": [(ent.text, ent.label_) for ent in doc.ents],
-                }
-
-                # Write the enhanced data
-                outfile.write(json.dumps(sentence_with_terms, ensure_ascii=False) + '\n')
+        # Write remaining sentences
+        outfile.writelines(out_buf)
     
     print(f"\nProcessing complete! Output written to {output_file}")
 
 def main():
-    if len(sys.argv) != 5:
-        print("Usage: python main.py <language_code> <sentences.jsonl> <multiword_terms.txt> <output.jsonl>")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    args = sys.argv[1:]
+    with_entities = "--with-entities" in args
+    args = [arg for arg in args if arg != "--with-entities"]
+
+    if len(args) != 4:
+        print("Usage: python main.py [--with-entities] <language_code> <sentences.jsonl> <multiword_terms.txt> <output.jsonl>")
         print("Language code should be ISO 639-3 (e.g., 'fra' for French, 'spa' for Spanish)")
+        print("Named entities are only extracted with --with-entities")
         sys.exit(1)
     
-    language_code = sys.argv[1]
-    sentences_file = sys.argv[2]
-    terms_file = sys.argv[3]
-    output_file = sys.argv[4]
+    language_code = args[0]
+    sentences_file = args[1]
+    terms_file = args[2]
+    output_file = args[3]
     
-    process_sentences(sentences_file, terms_file, output_file, language_code)
+    process_sentences(sentences_file, terms_file, output_file, language_code, with_entities)
 
 
 if __name__ == "__main__":